@@ -1,4 +1,3 @@
-import csv
 from happytransformer.happy_text_to_text import HappyTextToText, TTTrainArgs
 from datasets import load_dataset
 
@@ -18,6 +17,7 @@ def main():
                 num_train_epochs=1,
                 max_input_length=1024,
                 max_output_length=1024,
+                # gradient_checkpointing=True,
                 # fp16=True,
                 # report_to = ('wandb'),
                 # project_name = "happy-transformer-examples",
@@ -32,13 +32,14 @@ def main():
 
 
 def generate_csv(csv_path, dataset):
-    with open(csv_path, 'w', newline='') as csvfile:
-        writter = csv.writer(csvfile)
-        writter.writerow(["input", "target"])
-        for case in dataset:
-            english_text = "translate English to Persian: " + case["source"]
-            persian_text = case["targets"][0]
-            writter.writerow([english_text, persian_text])
+    def format_cases(cases):
+        return {
+            "input": ["translate English to Persian: " + english_text for english_text in cases["source"]],
+            "target": [persian_texts[0] for persian_texts in cases["targets"]]
+        }
+
+    csv_dataset = dataset.map(format_cases, batched=True, remove_columns=dataset.column_names, num_proc=4)
+    csv_dataset.to_csv(csv_path, index=False)
 
 
 if __name__ == "__main__":
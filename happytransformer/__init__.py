@@ -5,6 +5,7 @@ from happytransformer.happy_next_sentence import HappyNextSentence
 from happytransformer.happy_token_classification import HappyTokenClassification
 from happytransformer.happy_generation import HappyGeneration, GENSettings
 from happytransformer.happy_text_to_text import HappyTextToText, TTSettings
+from happytransformer.happy_transformer import configure_cpu_threads
 
 from happytransformer.args import (
     GENTrainArgs, GENEvalArgs,
@@ -9,6 +9,7 @@ class TrainArgs:
     batch_size: int = 1
     weight_decay: float = 0
     fp16: bool = False
+    gradient_checkpointing: bool = False  # saves memory at the cost of recomputing activations during the backward pass
     eval_ratio: float = 0.1  #  if eval_filepath is not provided a portion of the training data will be used for evaluating.
 
     save_steps: float = 0.0 #  if 0 no saving will be done
@@ -17,10 +18,15 @@ class TrainArgs:
 
     save_path:  Union[bool, str] = False
     load_path:  Union[bool, str] = False
+    # Preprocessed data is saved to and reused from a sub-folder of this folder based on a hash of the data and settings
+    preprocessed_cache_dir: Union[bool, str] = False
 
     report_to: tuple = ()
     deepspeed: Union[bool, str] = False
 
+    # Number of processes used to tokenize the data
+    preprocessing_processes: int = 1
+
     # Currently used to create a project and run ID for wandb
     project_name: str = "happy-transformer"
     run_name: str = "test"
@@ -29,6 +35,7 @@ class TrainArgs:
 class EvalArgs:
     batch_size: int = 1
     deepspeed: Union[bool, str] = False
+    preprocessing_processes: int = 1
 
     save_path:  Union[bool, str] = False
     load_path:  Union[bool, str] = False
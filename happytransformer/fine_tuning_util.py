@@ -28,7 +28,8 @@ def tok_text_gen_mlm(tokenizer: PreTrainedTokenizer, dataset: Dataset, args: Uni
         return tokenizer(texts)
 
     tokenized_dataset = dataset.map(tokenize_function, batched=True,
-                                      remove_columns=["text"])
+                                      num_proc=args.preprocessing_processes,
+                                      remove_columns=dataset.column_names)
 
     def group_texts(examples):
         concatenated_examples = {k: sum(examples[k], []) for k in examples.keys()}
@@ -53,7 +54,8 @@ def tok_text_gen_mlm(tokenizer: PreTrainedTokenizer, dataset: Dataset, args: Uni
 
     tokenized_dataset = tokenized_dataset.map(
         group_texts,
-        batched=True)
+        batched=True,
+        num_proc=args.preprocessing_processes)
 
 
     return tokenized_dataset
@@ -67,14 +69,18 @@ def csv_tok_text_gen_mlm(tokenizer: PreTrainedTokenizer, dataset: Dataset, args:
 
     def tokenize_function(example):
         texts = example["text"]
-        toks = tokenizer(texts, padding="max_length", truncation=True, max_length=max_input_length)
+        # Rows are padded per batch by the data collator rather than to max_input_length here
+        toks = tokenizer(texts, truncation=True, max_length=max_input_length)
         if not mlm:
             toks["labels"] = toks["input_ids"]
+        # Used to group cases of similar lengths into the same batch
+        toks["length"] = [len(input_ids) for input_ids in toks["input_ids"]]
         return toks
 
     dataset= dataset.map(tokenize_function,
                 batched=True,
-                remove_columns=["text"])
+                num_proc=args.preprocessing_processes,
+                remove_columns=dataset.column_names)
 
     return dataset
 
@@ -0,0 +1,132 @@
+"""
+Helpers used by HappyGeneration when it calls model.generate() directly
+"""
+
+from typing import List
+
+import torch
+from transformers import LogitsProcessor
+
+
+def expand_past_key_values(past_key_values, num_beams: int):
+    # Repeats the key/values of each sequence num_beams times along the batch dimension,
+    # matching how model.generate() expands input_ids for beam search.
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(num_beams)
+        return past_key_values
+
+    return tuple(
+        tuple(tensor.repeat_interleave(num_beams, dim=0) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def to_legacy_cache(past_key_values):
+    # Newer versions of transformers may return a Cache object instead of tuples
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def pad_past_key_values(past_key_values, length: int):
+    # Left pads the key/values of a batch to length along the sequence dimension.
+    # Tensors are shaped [batch, num_heads, sequence_length, head_dim].
+    return tuple(
+        tuple(torch.nn.functional.pad(tensor, (0, 0, length - tensor.shape[-2], 0)) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def write_past_key_values_row(past_key_values, row: int, row_past_key_values):
+    # Overwrites one row of a batched, left padded cache in place with the key/values of a single sequence.
+    # Only the row being written is touched, the rest of the batch is left as it is.
+    for layer, row_layer in zip(past_key_values, row_past_key_values):
+        for tensor, row_tensor in zip(layer, row_layer):
+            length = row_tensor.shape[-2]
+            tensor[row].zero_()
+            if length:
+                tensor[row, :, -length:] = row_tensor[0]
+
+
+class NGramBlockingLogitsProcessor(LogitsProcessor):
+    """
+    Prevents any n-gram of size ngram_size from being generated twice.
+    Gives the same result as transformers' NoRepeatNGramLogitsProcessor, but every
+    previous n-gram is compared against the current one with tensor operations
+    over the whole batch rather than by building a dictionary of n-grams in Python.
+    """
+    def __init__(self, ngram_size: int):
+        if ngram_size <= 0:
+            raise ValueError(f"ngram_size must be a positive integer, but is {ngram_size}")
+        self.ngram_size = ngram_size
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        sequence_length = input_ids.shape[1]
+        if sequence_length < self.ngram_size:
+            return scores
+
+        # [batch, num_ngrams, ngram_size]
+        ngrams = input_ids.unfold(1, self.ngram_size, 1)
+        # The last ngram_size - 1 tokens, which the next token would complete an n-gram with
+        current_prefix = input_ids[:, sequence_length - self.ngram_size + 1:]
+        matches = (ngrams[:, :, :-1] == current_prefix.unsqueeze(1)).all(dim=-1)
+
+        # scatter_add_ is used since the same token may be banned by several n-grams
+        banned = torch.zeros_like(scores, dtype=torch.long).scatter_add_(1, ngrams[:, :, -1], matches.long())
+
+        return scores.masked_fill(banned > 0, -float("inf"))
+
+
+class BadWordsMaskLogitsProcessor(LogitsProcessor):
+    """
+    Prevents the token sequences in bad_words_ids from being generated.
+    Gives the same result as transformers' NoBadWordsLogitsProcessor, but single token
+    bad words are banned with a precomputed mask and multi-token bad words are
+    matched against the end of every sequence with tensor operations.
+    """
+    def __init__(self, bad_words_ids: List[List[int]]):
+        bad_words_ids = [ids for ids in bad_words_ids if len(ids) > 0]
+        self.bad_words_ids = bad_words_ids
+        self._single_token_ids = sorted({ids[0] for ids in bad_words_ids if len(ids) == 1})
+
+        # Multi-token bad words grouped by length so that each group can be stacked into a tensor
+        self._phrases = {}
+        for ids in bad_words_ids:
+            if len(ids) > 1:
+                self._phrases.setdefault(len(ids), []).append(ids)
+
+        # Built upon the first call since the vocab size and device are only known then
+        self._bad_mask = None
+        self._phrase_tensors = None
+
+    def _build_tensors(self, scores: torch.FloatTensor):
+        vocab_size = scores.shape[-1]
+        self._bad_mask = torch.zeros(vocab_size, dtype=torch.bool, device=scores.device)
+        single_token_ids = [token_id for token_id in self._single_token_ids if token_id < vocab_size]
+        if single_token_ids:
+            self._bad_mask[single_token_ids] = True
+
+        self._phrase_tensors = {}
+        for length, phrases in self._phrases.items():
+            phrases = [ids for ids in phrases if ids[-1] < vocab_size]
+            if phrases:
+                phrases = torch.tensor(phrases, dtype=torch.long, device=scores.device)
+                self._phrase_tensors[length] = (phrases[:, :-1], phrases[:, -1])
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self._bad_mask is None or self._bad_mask.device != scores.device or self._bad_mask.shape[0] != scores.shape[-1]:
+            self._build_tensors(scores)
+
+        banned = self._bad_mask.expand_as(scores)
+
+        sequence_length = input_ids.shape[1]
+        for length, (prefixes, last_tokens) in self._phrase_tensors.items():
+            if sequence_length < length - 1:
+                continue
+            # [batch, num_phrases]
+            matches = (input_ids[:, sequence_length - length + 1:].unsqueeze(1) == prefixes.unsqueeze(0)).all(dim=-1)
+            counts = torch.zeros_like(scores, dtype=torch.long).scatter_add_(
+                1, last_tokens.expand(input_ids.shape[0], -1), matches.long())
+            banned = banned | (counts > 0)
+
+        return scores.masked_fill(banned, -float("inf"))
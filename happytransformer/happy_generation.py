@@ -1,12 +1,28 @@
 from dataclasses import dataclass
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
 from datasets import Dataset
-from transformers import AutoModelForCausalLM, default_data_collator, TextGenerationPipeline
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    DataCollatorForSeq2Seq,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper
+    )
 
 from happytransformer.adaptors import get_adaptor
 from happytransformer.args import GENEvalArgs, GENTrainArgs
 from happytransformer.fine_tuning_util import csv_tok_text_gen_mlm, EvalResult, tok_text_gen_mlm
+from happytransformer.generation_util import (
+    BadWordsMaskLogitsProcessor,
+    expand_past_key_values,
+    NGramBlockingLogitsProcessor,
+    pad_past_key_values,
+    to_legacy_cache,
+    write_past_key_values_row
+    )
 from happytransformer.happy_transformer import HappyTransformer
 
 @dataclass
@@ -21,28 +37,48 @@ class GENSettings:
     no_repeat_ngram_size: int = 0
     top_p: float = 1
     bad_words: List[str] = None
+    efficient_beam: bool = False
+    static_kv_cache: bool = False
 
 @dataclass
 class GenerationResult:
     text: str
 
+@dataclass
+class _StreamBatch:
+    # The rows currently being decoded by generate_stream(). The key/values of every row live in
+    # one batched cache that is left padded, so all rows end at the same position. The padding
+    # is hidden with cache_mask and a row is only rewritten when it is refilled with a new prompt.
+    indices: List[Union[int, None]]  # index of the prompt held by each row, None for free rows
+    prompt_lengths: List[int]
+    sequences: torch.Tensor  # prompt and generated tokens, shape [rows, length], left padded
+    cache_mask: torch.Tensor  # shape [rows, cache_length]
+    positions: torch.Tensor  # position id of the next token for each row, shape [rows]
+    num_generated: torch.Tensor  # shape [rows]
+    past_key_values: tuple = None
+
 
 class HappyGeneration(HappyTransformer):
     def __init__(self, model_type: str = "GPT2", model_name: str = "gpt2", 
-                 load_path: str = "", use_auth_token:  Union[bool, str]  = None, trust_remote_code: bool =False):
+                 load_path: str = "", use_auth_token:  Union[bool, str]  = None, trust_remote_code: bool =False, jit_mode: bool = False,
+                 torch_dtype: Union[torch.dtype, None] = None):
 
         self.adaptor = get_adaptor(model_type)
         model_class = AutoModelForCausalLM
 
-        super().__init__(model_type, model_name, model_class,  use_auth_token=use_auth_token, load_path=load_path, trust_remote_code=trust_remote_code)
+        super().__init__(model_type, model_name, model_class,  use_auth_token=use_auth_token, load_path=load_path, trust_remote_code=trust_remote_code, jit_mode=jit_mode, torch_dtype=torch_dtype)
 
-        self._data_collator = default_data_collator
+        # CSV rows are tokenized without padding, so each batch is padded to its longest row.
+        # Labels are padded with -100 so that the padding is ignored by the loss.
+        self._data_collator = DataCollatorForSeq2Seq(self.tokenizer)
 
         self._t_data_file_type = ["text", "csv"]
 
         self._type = "gen"
 
-        self._pipeline_class = TextGenerationPipeline
+        self._pipeline_class = None  # model.generate() is called directly for inference
+
+        self._bad_words_cache: Dict[Tuple[str, ...], BadWordsMaskLogitsProcessor] = {}
 
     def load_model(self):
         pass
@@ -57,32 +93,324 @@ class HappyGeneration(HappyTransformer):
 
     def generate_text(self, text: str, args: GENSettings=GENSettings()) -> GenerationResult:
 
-        # loads pipeline if it hasn't been loaded already.
-        self._load_pipeline()
-
         self.__assert_default_text_is_val(text)
-        input_ids = self.tokenizer.encode(text, return_tensors="pt")
-        adjusted_min_length = args.min_length + len(input_ids[0])
-        adjusted_max_length = args.max_length + len(input_ids[0])
-        if args.bad_words:
-            bad_words_ids = [self.tokenizer(" "+phrase.strip()).input_ids for phrase in args.bad_words]
+
+        self._move_to_device()
+
+        # model.generate() is called directly rather than through a pipeline so that the text is only tokenized once
+        input_ids = self.tokenizer(text, return_tensors="pt")["input_ids"].to(self.device)
+        attention_mask = torch.ones_like(input_ids)
+
+        model_kwargs = {}
+        if args.efficient_beam and args.num_beams > 1:
+            model_kwargs = self.__get_shared_prefix_kwargs(input_ids, attention_mask, args)
+
+        output_ids = self.__generate_ids(input_ids, attention_mask, args, **model_kwargs)
+
+        return GenerationResult(text=self.tokenizer.decode(output_ids[0], skip_special_tokens=True))
+
+
+    def generate_texts(self, texts: List[str], args: GENSettings=GENSettings(), batch_size: int = 8) -> List[GenerationResult]:
+        """
+        Generates text for multiple prompts by running batches through model.generate().
+        Prompts are sorted by length before being batched to minimize padding.
+        Results are returned in the same order as texts.
+        """
+        if not isinstance(texts, list):
+            raise ValueError("The texts input must be a list of strings")
+        for text in texts:
+            self.__assert_default_text_is_val(text)
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+        self._move_to_device()
+
+        # The prompts are tokenized once. Causal LMs continue from the end of the prompt, so the padding goes on the left
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            encoded = self.tokenizer(texts, padding=True, return_tensors="pt")
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+        lengths = encoded["attention_mask"].sum(dim=-1).tolist()
+        sorted_indices = sorted(range(len(texts)), key=lambda i: lengths[i])
+
+        results = [None] * len(texts)
+        for start in range(0, len(sorted_indices), batch_size):
+            batch_indices = sorted_indices[start: start + batch_size]
+            # Only keep the padding needed by the longest prompt in the batch
+            max_length = max(lengths[i] for i in batch_indices)
+            input_ids = encoded["input_ids"][batch_indices, -max_length:].to(self.device)
+            attention_mask = encoded["attention_mask"][batch_indices, -max_length:].to(self.device)
+
+            output_ids = self.__generate_ids(input_ids, attention_mask, args)
+            batch_outputs = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+            for i, output in zip(batch_indices, batch_outputs):
+                results[i] = GenerationResult(text=output)
+
+        return results
+
+    def generate_stream(self, texts: Iterable[str], args: GENSettings=GENSettings(), batch_size: int = 8) -> Iterator[Tuple[int, GenerationResult]]:
+        """
+        Generates text for a stream of prompts. Up to batch_size prompts are decoded together
+        and whenever one of them finishes its slot is refilled with the next prompt from texts.
+        Yields (index, GenerationResult) tuples in the order the generations finish,
+        where index is the position of the prompt within texts.
+        Supports greedy decoding and sampling.
+        """
+        if args.num_beams > 1:
+            raise ValueError("generate_stream() does not support beam search. Set num_beams to 1")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+        self._move_to_device()
+
+        logits_processor, logits_warper = self.__get_stream_processors(args)
+
+        pending = enumerate(texts)
+        exhausted = False
+        batch = self.__new_stream_batch(batch_size)
+
+        while True:
+            # Find new prompts for the free rows
+            new_rows = []
+            for row in range(len(batch.indices)):
+                if exhausted or batch.indices[row] is not None:
+                    continue
+                next_text = next(pending, None)
+                if next_text is None:
+                    exhausted = True
+                    break
+                index, text = next_text
+                self.__assert_default_text_is_val(text)
+                new_rows.append((row, index, text))
+
+            with torch.inference_mode(), self._autocast():
+                for row, index, text in new_rows:
+                    self.__prefill_row(batch, row, index, text)
+
+                if exhausted:
+                    # Free rows will not be refilled, so they are dropped rather than decoded
+                    self.__drop_free_rows(batch)
+                if not batch.indices:
+                    break
+                if new_rows:
+                    self.__trim_stream_batch(batch)
+
+                finished_rows = self.__decode_step(batch, args, logits_processor, logits_warper)
+                results = [self.__row_result(batch, row) for row in finished_rows]
+
+            for row, result in zip(finished_rows, results):
+                batch.indices[row] = None
+                batch.prompt_lengths[row] = 0
+                yield result
+
+    def __get_stream_processors(self, args: GENSettings) -> Tuple[LogitsProcessorList, LogitsProcessorList]:
+        logits_processor = self.__get_logits_processor(args)
+
+        # Like model.generate(), the warpers are only used for sampling, so their settings aren't validated for greedy decoding
+        logits_warper = LogitsProcessorList()
+        if not args.do_sample:
+            return logits_processor, logits_warper
+        if args.temperature != 1:
+            logits_warper.append(TemperatureLogitsWarper(args.temperature))
+        if args.top_k > 0:
+            logits_warper.append(TopKLogitsWarper(args.top_k))
+        if args.top_p < 1:
+            logits_warper.append(TopPLogitsWarper(args.top_p))
+
+        return logits_processor, logits_warper
+
+    def __new_stream_batch(self, batch_size: int) -> _StreamBatch:
+        return _StreamBatch(
+            indices=[None] * batch_size,
+            prompt_lengths=[0] * batch_size,
+            sequences=torch.full((batch_size, 0), self.tokenizer.pad_token_id, dtype=torch.long, device=self.device),
+            cache_mask=torch.zeros((batch_size, 0), dtype=torch.long, device=self.device),
+            positions=torch.zeros(batch_size, dtype=torch.long, device=self.device),
+            num_generated=torch.zeros(batch_size, dtype=torch.long, device=self.device),
+        )
+
+    def __prefill_row(self, batch: _StreamBatch, row: int, index: int, text: str):
+        input_ids = self.tokenizer(text, return_tensors="pt")["input_ids"].to(self.device)
+        prompt_length = input_ids.shape[1]
+
+        # Every token but the last is run through the model here. The last token is
+        # fed by the next decode step so that the first new token is selected with the rest of the batch.
+        past_length = prompt_length - 1
+        if past_length:
+            row_past_key_values = to_legacy_cache(self.model(input_ids=input_ids[:, :-1], use_cache=True).past_key_values)
+            cache_length = batch.cache_mask.shape[1]
+            if batch.past_key_values is None:
+                batch.past_key_values = tuple(
+                    tuple(tensor.new_zeros((len(batch.indices),) + tensor.shape[1:]) for tensor in layer)
+                    for layer in row_past_key_values
+                )
+                batch.cache_mask = torch.nn.functional.pad(batch.cache_mask, (past_length - cache_length, 0))
+            elif past_length > cache_length:
+                batch.past_key_values = pad_past_key_values(batch.past_key_values, past_length)
+                batch.cache_mask = torch.nn.functional.pad(batch.cache_mask, (past_length - cache_length, 0))
+            write_past_key_values_row(batch.past_key_values, row, row_past_key_values)
+
+        batch.cache_mask[row] = 0
+        if past_length:
+            batch.cache_mask[row, -past_length:] = 1
+
+        if prompt_length > batch.sequences.shape[1]:
+            batch.sequences = torch.nn.functional.pad(batch.sequences, (prompt_length - batch.sequences.shape[1], 0),
+                                                      value=self.tokenizer.pad_token_id)
+        batch.sequences[row] = self.tokenizer.pad_token_id
+        batch.sequences[row, -prompt_length:] = input_ids[0]
+
+        batch.positions[row] = past_length
+        batch.num_generated[row] = 0
+        batch.indices[row] = index
+        batch.prompt_lengths[row] = prompt_length
+
+    def __drop_free_rows(self, batch: _StreamBatch):
+        rows = [row for row, index in enumerate(batch.indices) if index is not None]
+        if len(rows) == len(batch.indices):
+            return
+        keep = torch.tensor(rows, dtype=torch.long, device=self.device)
+        batch.indices = [batch.indices[row] for row in rows]
+        batch.prompt_lengths = [batch.prompt_lengths[row] for row in rows]
+        batch.sequences = batch.sequences[keep]
+        batch.cache_mask = batch.cache_mask[keep]
+        batch.positions = batch.positions[keep]
+        batch.num_generated = batch.num_generated[keep]
+        if batch.past_key_values is not None:
+            batch.past_key_values = tuple(tuple(tensor[keep] for tensor in layer) for layer in batch.past_key_values)
+
+    def __trim_stream_batch(self, batch: _StreamBatch):
+        # Once the rows that started first have been replaced, the leftmost cache positions are padding
+        # for every row. Slicing them off is free and stops the cache from growing with the stream.
+        valid_positions = batch.cache_mask.any(dim=0)
+        if valid_positions.any():
+            start = int(valid_positions.int().argmax())
+            if start:
+                batch.cache_mask = batch.cache_mask[:, start:]
+                batch.past_key_values = tuple(
+                    tuple(tensor[:, :, start:] for tensor in layer) for layer in batch.past_key_values
+                )
+
+        num_generated = batch.num_generated.tolist()
+        sequence_length = max(prompt_length + num_generated[row] if batch.indices[row] is not None else 0
+                              for row, prompt_length in enumerate(batch.prompt_lengths))
+        if sequence_length < batch.sequences.shape[1]:
+            batch.sequences = batch.sequences[:, -sequence_length:]
+
+    def __decode_step(self, batch: _StreamBatch, args: GENSettings,
+                      logits_processor: LogitsProcessorList, logits_warper: LogitsProcessorList) -> List[int]:
+        ones = torch.ones((len(batch.indices), 1), dtype=torch.long, device=self.device)
+        attention_mask = torch.cat([batch.cache_mask, ones], dim=-1)
+
+        outputs = self.model(input_ids=batch.sequences[:, -1:],
+                             attention_mask=attention_mask,
+                             position_ids=batch.positions.unsqueeze(-1),
+                             past_key_values=batch.past_key_values,
+                             use_cache=True)
+
+        batch.past_key_values = to_legacy_cache(outputs.past_key_values)
+        batch.cache_mask = attention_mask
+        batch.positions += 1
+
+        scores = outputs.logits[:, -1, :].float()
+        eos_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is not None:
+            below_min_length = batch.num_generated < args.min_length
+            scores[:, eos_token_id] = scores[:, eos_token_id].masked_fill(below_min_length, -float("inf"))
+        scores = logits_processor(batch.sequences, scores)
+
+        if args.do_sample:
+            scores = logits_warper(batch.sequences, scores)
+            next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
         else:
-            bad_words_ids = None
-
-        output = self._pipeline(text, min_length=adjusted_min_length,
-                                return_full_text=False,
-                                max_length=adjusted_max_length,
-                                do_sample=args.do_sample,
-                                early_stopping=args.early_stopping,
-                                num_beams=args.num_beams,
-                                temperature=args.temperature,
-                                top_k=args.top_k,
-                                no_repeat_ngram_size=args.no_repeat_ngram_size,
-                                top_p=args.top_p,
-                                bad_words_ids=bad_words_ids
-                                )
-        return GenerationResult(text=output[0]['generated_text'])
+            next_tokens = torch.argmax(scores, dim=-1, keepdim=True)
+
+        batch.sequences = torch.cat([batch.sequences, next_tokens], dim=-1)
+        batch.num_generated += 1
+
+        finished = batch.num_generated >= args.max_length
+        if eos_token_id is not None:
+            finished |= next_tokens[:, 0] == eos_token_id
+
+        # A single transfer from the device for the whole batch
+        return finished.nonzero().flatten().tolist()
+
+    def __row_result(self, batch: _StreamBatch, row: int) -> Tuple[int, GenerationResult]:
+        num_generated = int(batch.num_generated[row])
+        text = self.tokenizer.decode(batch.sequences[row, batch.sequences.shape[1] - num_generated:], skip_special_tokens=True)
+        return batch.indices[row], GenerationResult(text=text)
+
+    def __get_shared_prefix_kwargs(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, args: GENSettings) -> dict:
+        if input_ids.shape[1] <= 1:
+            return {}
+
+        # The prompt's key/values are computed once for a single sequence and then
+        # shared by every beam, rather than being recomputed num_beams times.
+        with torch.inference_mode(), self._autocast():
+            prefix = self.model(input_ids=input_ids[:, :-1],
+                                attention_mask=attention_mask[:, :-1],
+                                use_cache=True)
+
+        return {"past_key_values": expand_past_key_values(prefix.past_key_values, args.num_beams)}
+
+    def __generate_ids(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, args: GENSettings, **model_kwargs) -> torch.Tensor:
+        # Returns only the newly generated token ids
+        input_length = input_ids.shape[1]
+        if "past_key_values" not in model_kwargs:
+            model_kwargs.update(self.__get_cache_kwargs(args))
+
+        with torch.inference_mode(), self._autocast():
+            output_ids = self.model.generate(input_ids=input_ids,
+                                             attention_mask=attention_mask,
+                                             min_length=args.min_length + input_length,
+                                             max_length=args.max_length + input_length,
+                                             do_sample=args.do_sample,
+                                             early_stopping=args.early_stopping,
+                                             num_beams=args.num_beams,
+                                             temperature=args.temperature,
+                                             top_k=args.top_k,
+                                             logits_processor=self.__get_logits_processor(args),
+                                             top_p=args.top_p,
+                                             pad_token_id=self.tokenizer.pad_token_id,
+                                             use_cache=True,
+                                             **model_kwargs
+                                             )
+
+        return output_ids[:, input_length:]
+
+    def __get_logits_processor(self, args: GENSettings) -> LogitsProcessorList:
+        # Used in place of transformers' no_repeat_ngram_size and bad_words_ids which check the tokens in Python at every step
+        logits_processor = LogitsProcessorList()
+        if args.no_repeat_ngram_size > 0:
+            logits_processor.append(NGramBlockingLogitsProcessor(args.no_repeat_ngram_size))
+        if args.bad_words:
+            logits_processor.append(self.__get_bad_words_processor(args.bad_words))
+        return logits_processor
+
+    def __get_cache_kwargs(self, args: GENSettings) -> dict:
+        if not args.static_kv_cache:
+            return {}
+
+        # A static cache allocates the key/values for the full max_length once instead of growing them every step.
+        # Requires transformers 4.38 or later and a model that supports it.
+        if not getattr(self.model, "_supports_static_cache", False):
+            self.logger.warning(f"{self.model.__class__.__name__} does not support a static KV cache. A dynamic cache will be used instead.")
+            return {}
+
+        return {"cache_implementation": "static"}
+
+    def __get_bad_words_processor(self, bad_words: List[str]) -> BadWordsMaskLogitsProcessor:
+        # The processor keeps its mask of banned tokens, so it's reused for repeated calls with the same bad words
+        key = tuple(bad_words)
+        if key not in self._bad_words_cache:
+            phrases = [" " + phrase.strip() for phrase in bad_words]
+            bad_words_ids = self.tokenizer(phrases, add_special_tokens=False).input_ids
+            self._bad_words_cache[key] = BadWordsMaskLogitsProcessor(bad_words_ids)
 
+        return self._bad_words_cache[key]
 
     def __post_process_generated_text(self, result, text):
         return result[len(text):]
@@ -116,7 +116,8 @@ class HappyQuestionAnswering(HappyTransformer):
         tok_dataset = raw_dataset.map(
             __preprocess_function,
             batched=False,
-            remove_columns=["context", "question", "answer_text", "answer_start"],
+            num_proc=args.preprocessing_processes,
+            remove_columns=raw_dataset.column_names,
             desc="Tokenizing data"
         )
 
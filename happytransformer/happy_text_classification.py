@@ -4,7 +4,7 @@ from typing import Union
 from dataclasses import dataclass
 from datasets import Dataset
 from tqdm import tqdm
-from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, DataCollatorWithPadding, TextClassificationPipeline
+from transformers import AutoConfig, AutoModelForSequenceClassification, DataCollatorWithPadding, TextClassificationPipeline
 
 from happytransformer.adaptors import get_adaptor
 from happytransformer.args import TCEvalArgs, TCTestArgs, TCTrainArgs
@@ -76,7 +76,8 @@ class HappyTextClassification(HappyTransformer):
         tok_dataset = raw_dataset.map(
             __preprocess_function,
             batched=True,
-            remove_columns=["text", "label"],
+            num_proc=args.preprocessing_processes,
+            remove_columns=raw_dataset.column_names,
             desc="Tokenizing data"
         )
 
@@ -101,7 +102,7 @@ class HappyTextClassification(HappyTransformer):
         # HappyTextClassification is the only class that overwrites
         # this as we need to specify number of labels.
         config = AutoConfig.from_pretrained(model_name_path, use_auth_token=use_auth_token,  num_labels=self._num_labels)
-        model = model_class.from_pretrained(model_name_path, config=config, use_auth_token=use_auth_token)
-        tokenizer = AutoTokenizer.from_pretrained(model_name_path, use_auth_token=use_auth_token)
+        model = self._load_model(model_class, model_name_path, config=config, use_auth_token=use_auth_token, torch_dtype=self.torch_dtype, **self._get_device_kwargs())
+        tokenizer = self._get_tokenizer(model_name_path, use_auth_token)
 
         return config, tokenizer, model
\ No newline at end of file
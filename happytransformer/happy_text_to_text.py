@@ -2,6 +2,7 @@ from dataclasses import dataclass
 from typing import Union
 
 from datasets import Dataset
+import torch
 from transformers import AutoModelForSeq2SeqLM, DataCollatorForSeq2Seq, Text2TextGenerationPipeline
 
 from happytransformer.adaptors import get_adaptor
@@ -30,16 +31,18 @@ class HappyTextToText(HappyTransformer):
     """
     A user facing class for text to text generation
     """
-    def __init__(self, model_type: str = "T5", model_name: str = "t5-small", load_path: str = "", use_auth_token: Union[bool, str] = None,  trust_remote_code: bool =False):
+    def __init__(self, model_type: str = "T5", model_name: str = "t5-small", load_path: str = "", use_auth_token: Union[bool, str] = None,  trust_remote_code: bool =False,
+                 torch_dtype: Union[torch.dtype, None] = None):
 
         self.adaptor = get_adaptor(model_type)
         model_class = AutoModelForSeq2SeqLM
 
-        super().__init__(model_type, model_name, model_class, use_auth_token=use_auth_token, load_path=load_path, trust_remote_code=trust_remote_code)
+        super().__init__(model_type, model_name, model_class, use_auth_token=use_auth_token, load_path=load_path, trust_remote_code=trust_remote_code, torch_dtype=torch_dtype)
 
         self._pipeline_class = Text2TextGenerationPipeline
 
-        self._data_collator = DataCollatorForSeq2Seq(self.tokenizer, model=self.model)
+        # Padding to a multiple of 8 lets fp16 training use tensor cores
+        self._data_collator = DataCollatorForSeq2Seq(self.tokenizer, model=self.model, pad_to_multiple_of=8)
         self._t_data_file_type = ["csv"]
         self._type = "tt"
 
@@ -59,16 +62,17 @@ class HappyTextToText(HappyTransformer):
 
         self.__assert_default_text_is_val(text)
 
-        output = self._pipeline(text, min_length=args.min_length,
-                                max_length=args.max_length,
-                                do_sample=args.do_sample,
-                                early_stopping=args.early_stopping,
-                                num_beams=args.num_beams,
-                                temperature=args.temperature,
-                                top_k=args.top_k,
-                                no_repeat_ngram_size=args.no_repeat_ngram_size,
-                                top_p=args.top_p,
-                                )
+        with torch.inference_mode(), self._autocast():
+            output = self._pipeline(text, min_length=args.min_length,
+                                    max_length=args.max_length,
+                                    do_sample=args.do_sample,
+                                    early_stopping=args.early_stopping,
+                                    num_beams=args.num_beams,
+                                    temperature=args.temperature,
+                                    top_k=args.top_k,
+                                    no_repeat_ngram_size=args.no_repeat_ngram_size,
+                                    top_p=args.top_p,
+                                    )
         return TextToTextResult(text=output[0]['generated_text'])
 
     def train(self, input_filepath, args: TTTrainArgs=TTTrainArgs(),  eval_filepath: str = ""):
@@ -100,12 +104,15 @@ class HappyTextToText(HappyTransformer):
             labels = self.tokenizer(examples["target"], max_length=max_output_length, truncation=True)
 
             model_inputs["labels"] = labels["input_ids"]
+            # Used to group cases of similar lengths into the same batch
+            model_inputs["length"] = [len(input_ids) for input_ids in model_inputs["input_ids"]]
             return model_inputs
 
         tok_dataset = raw_dataset.map(
             __preprocess_function,
             batched=True,
-            remove_columns=["input", "target"],
+            num_proc=args.preprocessing_processes,
+            remove_columns=raw_dataset.column_names,
         )
 
         return tok_dataset
\ No newline at end of file
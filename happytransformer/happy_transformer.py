@@ -1,9 +1,12 @@
+import hashlib
 import logging
 import os
+import shutil
 import tempfile
 from typing import Union
 
 from datasets import Dataset, DatasetDict,  load_dataset, load_from_disk
+from packaging import version
 import torch
 from transformers import (
     AutoConfig,
@@ -18,11 +21,69 @@ from transformers import (
 from happytransformer.args import EvalArgs, TrainArgs
 from happytransformer.fine_tuning_util import EvalResult, FistStep, ZERO_2_SETTINGS, ZERO_3_SETTINGS
 
+
+def _get_device():
+    device = None
+    if torch.backends.mps.is_available():
+        if torch.backends.mps.is_built():
+            device = torch.device("mps")
+
+    if torch.cuda.is_available():
+        device = torch.device("cuda:0")
+
+    if not device:
+        device = torch.device("cpu")
+
+    return device
+
+# Detected once rather than every time a model is created
+_DEVICE = _get_device()
+
+
+def _is_distributed_launch():
+    # Set by torchrun, accelerate and the DeepSpeed launcher for every process they start
+    return "LOCAL_RANK" in os.environ or int(os.environ.get("WORLD_SIZE", "1")) > 1
+
+
+# Configured once so that creating many models doesn't add duplicate handlers
+_LOGGER = logging.getLogger("happytransformer")
+if not _LOGGER.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S'
+    ))
+    _LOGGER.addHandler(_handler)
+    _LOGGER.setLevel(logging.INFO)
+    # Messages are already printed by the handler above, so they aren't passed on to the root logger's handlers
+    _LOGGER.propagate = False
+
+
+def configure_cpu_threads():
+    """
+    Uses every CPU available to this process for intra-op parallelism and a single thread
+    for inter-op parallelism so that CPU inference runs with a predictable number of threads.
+    Not called by default since it changes the threading of the whole process.
+    Call it before any models are created.
+    """
+    # Respects CPU affinity and cgroup CPU sets, unlike os.cpu_count()
+    if hasattr(os, "sched_getaffinity"):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 1
+    torch.set_num_threads(num_cpus)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before any inter-op parallel work has started
+        _LOGGER.warning("The number of inter-op threads can't be changed after parallel work has started.")
+
+
 class HappyTransformer():
 
-    def __init__(self, model_type: str, model_name: str, model_class: AutoModel, load_path="", use_auth_token: Union[str, bool] = None, trust_remote_code: bool =False):
+    def __init__(self, model_type: str, model_name: str, model_class: AutoModel, load_path="", use_auth_token: Union[str, bool] = None, trust_remote_code: bool =False, jit_mode: bool = False, torch_dtype: Union[torch.dtype, None] = None):
 
-        self.logger = self._get_logger()
+        self.logger = _LOGGER
         self.model_type = model_type
         self.model_name = model_name
 
@@ -31,16 +92,30 @@ class HappyTransformer():
             self.logger.warning(f"load_path has been deprecated. Provide the load_path to the  model_name parameter instead {self.model_name}. load_path will be removed in a later version. For now, we'll load the model form the load_path provided.  ")
             self.model_name = load_path
 
-        self.config, self.tokenizer, self.model = self._get_model_components(self.model_name, use_auth_token, trust_remote_code, model_class)
+        self.torch_dtype = torch_dtype
 
-        self.device = self.__get_device()
+        self.device = _DEVICE
 
         self.logger.info("Using device: %s", self.device)
 
+        # The model's weights are loaded directly onto self.device, except for distributed launches
+        # where the Trainer/DeepSpeed places the model for each process.
+        self._load_on_device = not _is_distributed_launch()
+
+        self.config, self.tokenizer, self.model = self._get_model_components(self.model_name, use_auth_token, trust_remote_code, model_class)
+
         if self.tokenizer.pad_token is None and self.tokenizer.eos_token is not None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
 
-        self.model.resize_token_embeddings(len(self.tokenizer))
+        # Inference is performed with dropout disabled. Trainer switches the model back to training mode when training.
+        self.model.eval()
+
+        # Resizing allocates a new embedding matrix, so it's only done when the sizes differ
+        if self.model.get_input_embeddings().num_embeddings != len(self.tokenizer):
+            self.model.resize_token_embeddings(len(self.tokenizer))
+
+        if jit_mode:
+            self._compile_model()
 
         # Set within the child classes.
         self._data_collator = None
@@ -51,7 +126,11 @@ class HappyTransformer():
         # Loaded in upon first time calling text generation.
         self._pipeline = None
 
-        self._on_device = False
+        # Tokenized training data from previous calls to train()
+        self._tok_data_cache = {}
+
+        # Whether the model is currently on self.device. _load_on_device only records where the weights were loaded.
+        self._on_device = self._load_on_device
 
     ######## Children of
     def _tok_function(self, raw_dataset, args: TrainArgs, format: str) -> Dataset:
@@ -64,37 +143,42 @@ class HappyTransformer():
         # this as we need to specify number of labels.
 
         config = AutoConfig.from_pretrained(model_name_path, use_auth_token=use_auth_token, trust_remote_code=trust_remote_code)
-        model = model_class.from_pretrained(model_name_path, config=config, use_auth_token=use_auth_token, trust_remote_code=trust_remote_code)
-        tokenizer = AutoTokenizer.from_pretrained(model_name_path, use_auth_token=use_auth_token, trust_remote_code=trust_remote_code)
+        model = self._load_model(model_class, model_name_path, config=config, use_auth_token=use_auth_token, trust_remote_code=trust_remote_code, torch_dtype=self.torch_dtype, **self._get_device_kwargs())
+        tokenizer = self._get_tokenizer(model_name_path, use_auth_token, trust_remote_code)
 
         return config, tokenizer, model
 
-    def _get_logger(self) :
-        logger = logging.getLogger(__name__)
-        handler = logging.StreamHandler()
-        handler.addFilter(logging.Filter('happytransformer'))
-        logging.basicConfig(
-            format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
-            datefmt='%m/%d/%Y %H:%M:%S',
-            level=logging.INFO,
-            handlers=[handler]
-        )
-        return logger
-
-
-    def __get_device(self):
-        device = None
-        if torch.backends.mps.is_available():
-            if torch.backends.mps.is_built():
-                device = torch.device("mps")
-
-        if torch.cuda.is_available():
-            device = torch.device("cuda:0")
-
-        if not device:
-            device = torch.device("cpu")
+    def _get_device_kwargs(self) -> dict:
+        # Loads the weights straight onto the device without first creating a full copy of the model on the CPU
+        device_kwargs = {"low_cpu_mem_usage": True}
+        if self._load_on_device and self.device.type != "cpu":
+            device_kwargs["device_map"] = {"": str(self.device)}
+        return device_kwargs
+
+    def _load_model(self, model_class, model_name_path, **kwargs):
+        # The attention implementation is left for transformers to choose. As of transformers 4.36.0
+        # it uses scaled dot product attention by default whenever the model and PyTorch version support it.
+        return model_class.from_pretrained(model_name_path, **kwargs)
+
+    def _get_tokenizer(self, model_name_path, use_auth_token, trust_remote_code=False):
+        try:
+            return AutoTokenizer.from_pretrained(model_name_path, use_fast=True, use_auth_token=use_auth_token, trust_remote_code=trust_remote_code)
+        except ValueError:
+            self.logger.warning("A fast tokenizer could not be loaded. Loading a slow tokenizer instead.")
+            return AutoTokenizer.from_pretrained(model_name_path, use_fast=False, use_auth_token=use_auth_token, trust_remote_code=trust_remote_code)
+
+    def _compile_model(self):
+        # Only forward() is compiled so that the model can still be trained and saved as usual.
+        if hasattr(torch, "compile"):
+            self.logger.info("Compiling model with torch.compile()")
+            self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead")
+        else:
+            self.logger.warning("jit_mode requires PyTorch 2.0 or later. The model will run in eager mode.")
 
-        return device
+    def _autocast(self):
+        # Mixed precision inference is only enabled for CUDA with a half precision torch_dtype.
+        enabled = self.device.type == "cuda" and self.torch_dtype in (torch.float16, torch.bfloat16)
+        return torch.autocast(device_type="cuda" if enabled else "cpu", dtype=self.torch_dtype if enabled else None, enabled=enabled)
 
     def train(self, input_filepath: str ,  args: TrainArgs, eval_filepath: str = "", ):
         if type(args) == dict:
@@ -134,35 +218,28 @@ class HappyTransformer():
     def _preprocess_data_train(self, input_filepath, eval_filepath, args: TrainArgs):
 
         if not args.load_path:
-            # We are loading raw data
-            if eval_filepath == "":
-
-                # eval_filepath was not provided so we use a portion of the training data for evaluating
-                file_type = self._check_file_type(input_filepath)
-                all_raw_data = load_dataset(file_type, data_files={"train": input_filepath}, split="train")
-                # Shuffle data
-                all_raw_data = all_raw_data.shuffle(seed=42)
-                # Split according to args.eval_ratio
-                split_text_data = all_raw_data.train_test_split(test_size=args.eval_ratio)
-                self.logger.info("Tokenizing training data...")
+            cache_key = self._get_tok_cache_key(input_filepath, eval_filepath, args)
 
-                train_tok_data = self._tok_function(split_text_data["train"], args, file_type)
-                eval_tok_data = self._tok_function(split_text_data["test"], args, file_type)
+            if cache_key in self._tok_data_cache:
+                # The same data has already been tokenized with the same settings, such as during a hyperparameter sweep.
+                self.logger.info("Using previously tokenized data...")
+                train_tok_data, eval_tok_data = self._tok_data_cache[cache_key]
             else:
-                # Eval path has been provided so we can load the evaluating data directly.
-                train_file_type = self._check_file_type(input_filepath)
-                eval_file_type = self._check_file_type(input_filepath)
-
-                if train_file_type != eval_file_type:
-                    raise ValueError("Train file-type must be the same as the eval file-type")
-
-                raw_data = load_dataset(train_file_type, data_files={"train": input_filepath, "eval": eval_filepath})
-
-                # todo combine logic below with above tokenizing logic
-                self.logger.info("Tokenizing training data...")
-                train_tok_data = self._tok_function(raw_data["train"], args, train_file_type)
-                self.logger.info("Tokenizing eval data...")
-                eval_tok_data = self._tok_function(raw_data["eval"], args, train_file_type)
+                # Only hashed on a miss since hashing reads all of the data
+                preprocessed_cache_path = self._get_preprocessed_cache_path(input_filepath, eval_filepath, args)
+
+                if preprocessed_cache_path and os.path.isdir(preprocessed_cache_path):
+                    # The same data was tokenized with the same settings during a previous run
+                    self.logger.info("Loading preprocessed data from %s...", preprocessed_cache_path)
+                    tok_data = load_from_disk(preprocessed_cache_path)
+                    train_tok_data = tok_data["train"]
+                    eval_tok_data = tok_data["eval"]
+                else:
+                    train_tok_data, eval_tok_data = self._tok_train_eval_data(input_filepath, eval_filepath, args)
+                    if preprocessed_cache_path:
+                        self._save_preprocessed_data(train_tok_data, eval_tok_data, preprocessed_cache_path)
+
+                self._tok_data_cache[cache_key] = (train_tok_data, eval_tok_data)
         else:
             if eval_filepath != "":
                 self.logger.warning(f"Eval data will be fetched from {args.load_path} and not {eval_filepath}")
@@ -179,6 +256,97 @@ class HappyTransformer():
         return train_tok_data, eval_tok_data
 
 
+    def _tok_train_eval_data(self, input_filepath, eval_filepath, args: TrainArgs):
+        if eval_filepath == "":
+
+            # eval_filepath was not provided so we use a portion of the training data for evaluating
+            file_type = self._check_file_type(input_filepath)
+            all_raw_data = load_dataset(file_type, data_files={"train": input_filepath}, split="train")
+            # Shuffle data
+            all_raw_data = all_raw_data.shuffle(seed=42)
+            # Split according to args.eval_ratio
+            split_text_data = all_raw_data.train_test_split(test_size=args.eval_ratio)
+            self.logger.info("Tokenizing training data...")
+
+            train_tok_data = self._tok_function(split_text_data["train"], args, file_type)
+            eval_tok_data = self._tok_function(split_text_data["test"], args, file_type)
+        else:
+            # Eval path has been provided so we can load the evaluating data directly.
+            train_file_type = self._check_file_type(input_filepath)
+            eval_file_type = self._check_file_type(eval_filepath)
+
+            if train_file_type != eval_file_type:
+                raise ValueError("Train file-type must be the same as the eval file-type")
+
+            if os.path.abspath(eval_filepath) == os.path.abspath(input_filepath):
+                raw_data = load_dataset(train_file_type, data_files={"train": input_filepath})
+                self.logger.info("Tokenizing training data...")
+                train_tok_data = self._tok_function(raw_data["train"], args, train_file_type)
+                # The eval data is the same file, so it does not need to be tokenized again
+                eval_tok_data = train_tok_data
+            else:
+                raw_data = load_dataset(train_file_type, data_files={"train": input_filepath, "eval": eval_filepath})
+
+                self.logger.info("Tokenizing training data...")
+                train_tok_data = self._tok_function(raw_data["train"], args, train_file_type)
+                self.logger.info("Tokenizing eval data...")
+                eval_tok_data = self._tok_function(raw_data["eval"], args, train_file_type)
+
+        return train_tok_data, eval_tok_data
+
+    def _save_preprocessed_data(self, train_tok_data, eval_tok_data, preprocessed_cache_path):
+        # The data is written to a temporary folder that is then renamed, so an interrupted run
+        # or two runs at the same time never leave a partly written cache behind.
+        self.logger.info("Saving preprocessed data to %s...", preprocessed_cache_path)
+        cache_dir = os.path.dirname(preprocessed_cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            DatasetDict({"train": train_tok_data, "eval": eval_tok_data}).save_to_disk(tmp_path)
+            os.replace(tmp_path, preprocessed_cache_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            # Another run may have saved the same data first
+            if not os.path.isdir(preprocessed_cache_path):
+                raise
+
+    def _get_tok_settings(self, args: Union[TrainArgs, EvalArgs]):
+        # Only settings that change the tokenized data
+        return tuple(
+            (name, getattr(args, name))
+            for name in ("max_length", "max_input_length", "max_output_length", "line_by_line")
+            if hasattr(args, name)
+        )
+
+    def _get_tok_cache_key(self, input_filepath, eval_filepath, args: TrainArgs):
+        # Modification times are included so that edited files are tokenized again.
+        files = tuple(
+            (os.path.abspath(path), os.path.getmtime(path))
+            for path in (input_filepath, eval_filepath) if path
+        )
+        eval_ratio = args.eval_ratio if not eval_filepath else None
+
+        return files, eval_ratio, self._get_tok_settings(args)
+
+    def _get_preprocessed_cache_path(self, input_filepath, eval_filepath, args: TrainArgs):
+        if not args.preprocessed_cache_dir:
+            return None
+
+        # The folder's name is a hash of the data's content and everything else that affects preprocessing
+        data_hash = hashlib.sha256()
+        for path in (input_filepath, eval_filepath):
+            if path:
+                with open(path, "rb") as data_file:
+                    for chunk in iter(lambda: data_file.read(1 << 20), b""):
+                        data_hash.update(chunk)
+            data_hash.update(b"\0")
+
+        eval_ratio = args.eval_ratio if not eval_filepath else None
+        settings = (self._type, self.model_name, len(self.tokenizer), eval_ratio, self._get_tok_settings(args))
+        data_hash.update(repr(settings).encode("utf-8"))
+
+        return os.path.join(args.preprocessed_cache_dir, data_hash.hexdigest())
+
     def _preprocess_data_eval(self, input_filepath, args: TrainArgs):
         if not args.load_path:
             self.logger.info("Preprocessing dataset...")
@@ -202,7 +370,7 @@ class HappyTransformer():
 
 
 
-    def _get_training_args(self, args):
+    def _get_training_args(self, args, group_by_length: bool = False):
         if self.device.type != "cuda":
             if args.fp16:
                 ValueError("fp16 is only available when CUDA/ a GPU is being used. ")
@@ -229,9 +397,15 @@ class HappyTransformer():
             logging_steps = args.logging_steps,
             per_device_train_batch_size=args.batch_size,
             per_device_eval_batch_size=args.batch_size,
+            # Batches cases of similar lengths together to reduce padding
+            group_by_length=group_by_length,
+            length_column_name="length",
             fp16=args.fp16,
+            gradient_checkpointing=args.gradient_checkpointing,
             use_mps_device= True if self.device.type == "mps" else False,
             run_name=args.run_name,
+            **self._get_optimizer_kwargs(args),
+            **self._get_dataloader_kwargs(train=True)
         )
 
 
@@ -243,12 +417,12 @@ class HappyTransformer():
         """
 
         # if model has not been moved to device and DeepSpeed is not being used
-        if not self._on_device and not args.deepspeed:
-                self.logger.info(f"Moving model to {self.device}")
-                self.model.to(self.device)
-                self._on_device = True
+        if not args.deepspeed:
+            self._move_to_device()
 
-        training_args = self._get_training_args(args)
+        # Only data with varying lengths has a length column, such as text-to-text data and
+        # CSV text generation and word prediction data. Grouped text files are already one fixed length.
+        training_args = self._get_training_args(args, group_by_length="length" in train_dataset.column_names)
 
         os.environ["WANDB_PROJECT"] = args.project_name
 
@@ -271,6 +445,9 @@ class HappyTransformer():
         trainer.add_callback(FistStep())
         trainer.train()
 
+        # Trainer leaves the model in training mode
+        self.model.eval()
+
     def _run_eval(self, dataset, data_collator, args):
         if self._type == "wp":
             self._data_collator.mlm_probability = args.mlm_probability
@@ -294,9 +471,41 @@ class HappyTransformer():
             report_to=['none'],
             per_device_eval_batch_size=args.batch_size,
             use_mps_device=True if self.device.type == "mps" else False,
-            deepspeed=deepspeed
+            fp16_full_eval=self.device.type == "cuda" and self.torch_dtype == torch.float16,
+            bf16_full_eval=self.device.type == "cuda" and self.torch_dtype == torch.bfloat16,
+            deepspeed=deepspeed,
+            **self._get_dataloader_kwargs(train=False)
         )
 
+    def _get_optimizer_kwargs(self, args: TrainArgs) -> dict:
+        # The fused AdamW kernel updates every parameter with a single kernel launch.
+        # It requires CUDA and PyTorch 2.0, or later than 2.0.0 when combined with fp16. DeepSpeed is left to manage its own optimizer.
+        if self.device.type != "cuda" or args.deepspeed:
+            return {}
+
+        torch_version = version.parse(version.parse(torch.__version__).base_version)
+        if torch_version < version.parse("2.0.0") or (args.fp16 and torch_version == version.parse("2.0.0")):
+            return {}
+
+        return {"optim": "adamw_torch_fused"}
+
+    def _get_dataloader_kwargs(self, train: bool) -> dict:
+        # Pinned memory and worker processes let batches be prepared and copied to the GPU while the previous batch is being processed.
+        if self.device.type != "cuda":
+            return {}
+
+        cpu_count = os.cpu_count() or 1
+        num_workers = max(2, cpu_count // 2) if train else max(1, cpu_count // 4)
+        dataloader_kwargs = {
+            "dataloader_pin_memory": True,
+            "dataloader_num_workers": num_workers
+        }
+        # dataloader_persistent_workers was added in transformers 4.36.0
+        if "dataloader_persistent_workers" in TrainingArguments.__dataclass_fields__:
+            dataloader_kwargs["dataloader_persistent_workers"] = True
+
+        return dataloader_kwargs
+
 
     def push(self, repo_name, private=True):
         self.logger.info("Pushing model...")
@@ -342,12 +551,14 @@ class HappyTransformer():
 
         if self._pipeline_class is not None and self._pipeline is None:
 
-            # if model has not been model has not been moved to device yet
-            if not self._on_device:
-                self.logger.info(f"Moving model to {self.device}")
-                self.model.to(self.device)
-                self._on_device = True
+            self._move_to_device()
 
             self.logger.info(f"Initializing a pipeline")
             self._pipeline = self._pipeline_class(model=self.model, tokenizer=self.tokenizer, device=self.device)
 
+    def _move_to_device(self):
+        # if model has not been moved to device yet
+        if not self._on_device:
+            self.logger.info(f"Moving model to {self.device}")
+            self.model.to(self.device)
+            self._on_device = True
@@ -90,7 +90,8 @@ class HappyWordPrediction(HappyTransformer):
                                      add_special_tokens=True, truncation=True)
 
                 tokenized_dataset = raw_dataset.map(tokenize_function, batched=True,
-                                                remove_columns=["text"])
+                                                num_proc=args.preprocessing_processes,
+                                                remove_columns=raw_dataset.column_names)
                 return tokenized_dataset
         else:
             return csv_tok_text_gen_mlm(tokenizer=self.tokenizer,
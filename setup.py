@@ -20,7 +20,7 @@ setup(
     keywords = ['bert', 'roberta', 'ai', "transformer", "happy", "HappyTransformer",  "classification",  "nlp", "nlu", "natural", "language", "processing", "understanding"],
 
     install_requires=[
-            'torch>=1.0',
+            'torch>=1.10',
             'tqdm>=4.43',
             'transformers>=4.30.1,<5.0.0',
             'datasets>=2.13.1,<3.0.0',
@@ -10,6 +10,8 @@ from happytransformer import (
 
 
 happy_gen =  HappyGeneration("GPT-2", "sshleifer/tiny-gpt2")
+# Randomly initialized, so unlike happy_gen its output depends on the prompt
+happy_gen_random = HappyGeneration("GPT-2", "hf-internal-testing/tiny-random-gpt2")
 
 happy_ns = HappyNextSentence("BERT", "bert-base-uncased")
 
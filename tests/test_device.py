@@ -1,13 +1,34 @@
 from tests import happy_gen
-from happytransformer import HappyGeneration
+import os
+
+import torch
+
+from happytransformer import configure_cpu_threads, HappyGeneration, HappyTextToText
 
 def test_pipeline_init():
-    happy = HappyGeneration("GPT-2", "sshleifer/tiny-gpt2")
+    happy = HappyTextToText("T5", "t5-small")
     assert happy._pipeline is None
 
-    assert not happy._on_device
+    # The model is loaded directly onto the device
+    assert happy._on_device
+    assert happy.model.device.type == happy.device.type
 
     happy.generate_text("Hello world ")
 
     assert happy._pipeline is not None
     assert happy._on_device
+
+def test_gen_device_init():
+    happy = HappyGeneration("GPT-2", "sshleifer/tiny-gpt2")
+
+    assert happy._on_device
+    assert happy.model.device.type == happy.device.type
+
+    happy.generate_text("Hello world ")
+
+    assert happy._pipeline is None
+
+def test_configure_cpu_threads():
+    configure_cpu_threads()
+    if hasattr(os, "sched_getaffinity"):
+        assert torch.get_num_threads() == len(os.sched_getaffinity(0))
@@ -1,3 +1,7 @@
+import os
+import shutil
+
+from datasets import load_dataset
 import torch
 
 from happytransformer import (
@@ -7,10 +11,13 @@ from happytransformer import (
     GENEvalArgs
 )
 import pytest
+from transformers import NoBadWordsLogitsProcessor, NoRepeatNGramLogitsProcessor
+
+from happytransformer.generation_util import BadWordsMaskLogitsProcessor, NGramBlockingLogitsProcessor
 
 from tests.run_save_load import run_save_load
 
-from tests import happy_gen
+from tests import happy_gen, happy_gen_random
 
 def test_default_simple():
     args = GENSettings(min_length=5, max_length=5)
@@ -25,6 +32,156 @@ def test_default_min_max_length():
     length = len(tokens[0])
     assert length == 5
 
+def test_generate_texts():
+    args = GENSettings(min_length=5, max_length=5)
+    texts = ["Artificial intelligence is ", "Hello", "Natural language processing is a field that"]
+    outputs = happy_gen.generate_texts(texts, args=args, batch_size=2)
+    assert len(outputs) == len(texts)
+    # Results must come back in the order of texts and match generating each prompt on its own
+    for text, output in zip(texts, outputs):
+        assert type(output.text) == str
+        assert output.text == happy_gen.generate_text(text, args=args).text
+
+
+def test_generate_stream():
+    args = GENSettings(min_length=5, max_length=5)
+    texts = ["Artificial intelligence is ", "Hello", "Natural language processing is a field that"]
+    outputs = list(happy_gen.generate_stream(iter(texts), args=args, batch_size=2))
+    assert sorted(index for index, _ in outputs) == [0, 1, 2]
+
+    # Greedy decoding must give the same result as generating each prompt on its own,
+    # including for the prompt that is added to a refilled row
+    for index, output in outputs:
+        assert type(output.text) == str
+        assert output.text == happy_gen.generate_text(texts[index], args=args).text
+
+
+def test_generate_stream_eos():
+    # A randomly initialized model, so that the generated tokens depend on the prompt
+    happy = HappyGeneration("GPT-2", "hf-internal-testing/tiny-random-gpt2")
+    texts = ["Hello", "Artificial intelligence is ", "Natural language processing is a field that"]
+
+    # Use the third token generated for the first prompt as the EOS token, so that the first prompt
+    # ends early while the other rows keep going and its row is refilled.
+    input_ids = happy.tokenizer(texts[0], return_tensors="pt").input_ids.to(happy.model.device)
+    output_ids = happy.model.generate(input_ids, attention_mask=torch.ones_like(input_ids), do_sample=False,
+                                      min_length=input_ids.shape[1] + 8, max_length=input_ids.shape[1] + 8,
+                                      pad_token_id=happy.tokenizer.pad_token_id)
+    eos_token_id = int(output_ids[0, input_ids.shape[1] + 2])
+    happy.tokenizer.eos_token = happy.tokenizer.convert_ids_to_tokens(eos_token_id)
+    happy.model.config.eos_token_id = happy.tokenizer.eos_token_id
+    happy.model.generation_config.eos_token_id = happy.tokenizer.eos_token_id
+
+    for min_length in (0, 5):
+        args = GENSettings(min_length=min_length, max_length=8)
+        outputs = list(happy.generate_stream(iter(texts), args=args, batch_size=2))
+        assert sorted(index for index, _ in outputs) == [0, 1, 2]
+        for index, output in outputs:
+            assert output.text == happy.generate_text(texts[index], args=args).text
+
+
+def test_generate_stream_sampling():
+    texts = ["Artificial intelligence is ", "Hello", "Natural language processing is a field that"]
+
+    # Sampling from only the most likely token is the same as greedy decoding
+    args_greedy = GENSettings(min_length=3, max_length=6)
+    args_sample = GENSettings(min_length=3, max_length=6, do_sample=True, top_k=1)
+    outputs = list(happy_gen.generate_stream(iter(texts), args=args_sample, batch_size=2))
+    for index, output in outputs:
+        assert output.text == happy_gen.generate_text(texts[index], args=args_greedy).text
+
+    # The warpers' settings are only used, and validated, when sampling
+    args_greedy_zero_temperature = GENSettings(min_length=3, max_length=6, temperature=0, top_p=2)
+    outputs = list(happy_gen.generate_stream(iter(texts), args=args_greedy_zero_temperature, batch_size=2))
+    assert len(outputs) == len(texts)
+
+
+def test_jit_mode():
+    happy_gen_jit = HappyGeneration("GPT-2", "sshleifer/tiny-gpt2", jit_mode=True)
+    args = GENSettings(min_length=5, max_length=5)
+    output = happy_gen_jit.generate_text("Artificial intelligence is ", args=args)
+    assert type(output.text) == str
+
+
+def test_torch_dtype():
+    happy_gen_bf16 = HappyGeneration("GPT-2", "sshleifer/tiny-gpt2", torch_dtype=torch.bfloat16)
+    assert happy_gen_bf16.model.dtype == torch.bfloat16
+
+    args = GENSettings(min_length=5, max_length=5)
+    output = happy_gen_bf16.generate_text("Artificial intelligence is ", args=args)
+    assert type(output.text) == str
+
+
+def test_static_kv_cache(monkeypatch):
+    args = GENSettings(min_length=5, max_length=5)
+    args_static = GENSettings(min_length=5, max_length=5, static_kv_cache=True)
+
+    if getattr(happy_gen.model, "_supports_static_cache", False):
+        output = happy_gen.generate_text("Artificial intelligence is ", args=args)
+        output_static = happy_gen.generate_text("Artificial intelligence is ", args=args_static)
+        assert output_static.text == output.text
+
+    # Record the arguments that reach model.generate()
+    generate_kwargs = []
+    generate = happy_gen.model.generate
+    def recording_generate(*func_args, **func_kwargs):
+        generate_kwargs.append(dict(func_kwargs))
+        func_kwargs.pop("cache_implementation", None)
+        return generate(*func_args, **func_kwargs)
+    monkeypatch.setattr(happy_gen.model, "generate", recording_generate)
+
+    # Falls back to the default cache when the model does not support a static cache
+    monkeypatch.setattr(happy_gen.model, "_supports_static_cache", False, raising=False)
+    happy_gen.generate_text("Artificial intelligence is ", args=args_static)
+    assert "cache_implementation" not in generate_kwargs[-1]
+
+    monkeypatch.setattr(happy_gen.model, "_supports_static_cache", True, raising=False)
+    happy_gen.generate_text("Artificial intelligence is ", args=args_static)
+    assert generate_kwargs[-1]["cache_implementation"] == "static"
+
+    happy_gen.generate_text("Artificial intelligence is ", args=args)
+    assert "cache_implementation" not in generate_kwargs[-1]
+
+
+def test_efficient_beam():
+    args = GENSettings(min_length=5, max_length=5, num_beams=3)
+    output = happy_gen.generate_text("Artificial intelligence is ", args=args)
+    args_efficient = GENSettings(min_length=5, max_length=5, num_beams=3, efficient_beam=True)
+    output_efficient = happy_gen.generate_text("Artificial intelligence is ", args=args_efficient)
+    assert type(output_efficient.text) == str
+    assert output_efficient.text == output.text
+
+
+def test_batched_generation_prompt_dependent():
+    # Prompts of different lengths whose outputs differ, so a wrong order, a stale cache row
+    # or a wrong position id changes the result
+    texts = [
+        "Hello",
+        "The quick brown fox jumps over the lazy dog and then",
+        "Artificial intelligence is ",
+        "Natural language processing is a field that combines linguistics with",
+        "Once upon a time",
+    ]
+    args = GENSettings(min_length=6, max_length=6)
+    expected = [happy_gen_random.generate_text(text, args=args).text for text in texts]
+    assert len(set(expected)) == len(texts)
+
+    outputs = happy_gen_random.generate_texts(texts, args=args, batch_size=2)
+    assert [output.text for output in outputs] == expected
+
+    outputs = list(happy_gen_random.generate_stream(iter(texts), args=args, batch_size=2))
+    assert sorted(index for index, _ in outputs) == list(range(len(texts)))
+    for index, output in outputs:
+        assert output.text == expected[index]
+
+    args_beam = GENSettings(min_length=6, max_length=6, num_beams=3)
+    args_efficient_beam = GENSettings(min_length=6, max_length=6, num_beams=3, efficient_beam=True)
+    for text in texts:
+        output = happy_gen_random.generate_text(text, args=args_beam)
+        output_efficient = happy_gen_random.generate_text(text, args=args_efficient_beam)
+        assert output_efficient.text == output.text
+
+
 def test_bad_words():
     # Test single words
     args_test_word_single = GENSettings(bad_words=["new", "tool"])
@@ -58,6 +215,28 @@ def test_top_p():
 
 
 
+def test_ngram_blocking_processor():
+    torch.manual_seed(42)
+    input_ids = torch.randint(0, 5, (4, 30))
+    scores = torch.rand(4, 10)
+
+    for ngram_size in [1, 2, 3]:
+        expected = NoRepeatNGramLogitsProcessor(ngram_size)(input_ids, scores.clone())
+        result = NGramBlockingLogitsProcessor(ngram_size)(input_ids, scores.clone())
+        assert torch.equal(result, expected)
+
+
+def test_bad_words_mask_processor():
+    torch.manual_seed(42)
+    input_ids = torch.randint(0, 5, (4, 30))
+    scores = torch.rand(4, 10)
+    bad_words_ids = [[3], [7], [1, 2], [4, 0, 6], [2, 8]]
+
+    expected = NoBadWordsLogitsProcessor(bad_words_ids, eos_token_id=9)(input_ids, scores.clone())
+    result = BadWordsMaskLogitsProcessor(bad_words_ids)(input_ids, scores.clone())
+    assert torch.equal(result, expected)
+
+
 def test_all_methods():
     greedy_settings = GENSettings(min_length=5, max_length=5, no_repeat_ngram_size=2)
     output_greedy = happy_gen.generate_text(
@@ -135,6 +314,56 @@ def test_gen_save_load_eval():
 
     run_save_load(happy_gen, output_path, args, data_path, "eval")
 
+def test_gen_preprocessed_cache(tmp_path):
+    data_path = "../data/gen/train-eval.txt"
+    args = GENTrainArgs(preprocessed_cache_dir=str(tmp_path))
+
+    happy_gen.train(data_path, args=args)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    happy = HappyGeneration("GPT-2", "sshleifer/tiny-gpt2")
+    happy.train(data_path, args=args)
+    assert len(list(tmp_path.iterdir())) == 1
+
+def test_gen_train_eval_file_type_mismatch():
+    with pytest.raises(ValueError):
+        happy_gen.train("../data/gen/train-eval.txt", eval_filepath="../data/gen/train-eval.csv")
+
+
+def test_gen_tok_data_cache(tmp_path, monkeypatch):
+    data_path = str(tmp_path / "train-eval.txt")
+    shutil.copy("../data/gen/train-eval.txt", data_path)
+    args = GENTrainArgs(num_train_epochs=1)
+
+    tok_calls = []
+    tok_function = happy_gen._tok_function
+    def counting_tok_function(*func_args, **func_kwargs):
+        tok_calls.append(1)
+        return tok_function(*func_args, **func_kwargs)
+    monkeypatch.setattr(happy_gen, "_tok_function", counting_tok_function)
+
+    happy_gen.train(data_path, args=args)
+    num_calls = len(tok_calls)
+    assert num_calls > 0
+
+    # The same file and settings are not tokenized again
+    happy_gen.train(data_path, args=args)
+    assert len(tok_calls) == num_calls
+
+    # A new modification time means the file may have changed, so it is tokenized again
+    stat = os.stat(data_path)
+    os.utime(data_path, (stat.st_atime, stat.st_mtime + 10))
+    happy_gen.train(data_path, args=args)
+    assert len(tok_calls) == 2 * num_calls
+
+
+def test_gen_csv_length_column():
+    # CSV rows are not padded, so their lengths are kept for grouping cases of similar lengths
+    raw_dataset = load_dataset("csv", data_files={"train": "../data/gen/train-eval.csv"}, split="train")
+    tok_dataset = happy_gen._tok_function(raw_dataset, GENTrainArgs(), "csv")
+    assert tok_dataset["length"] == [len(input_ids) for input_ids in tok_dataset["input_ids"]]
+
+
 def test_gen_save():
     happy_gen.save("model/")
     result_before = happy_gen.generate_text("Natural language processing is")